@@ -4,6 +4,8 @@ Module for performing statistical measures of player consistency
 
 import numpy as np
 import pandas as pd
+from functools import lru_cache
+from numba import njit
 from scipy import stats
 
 def measure_group_consistency(df, group):
@@ -20,60 +22,117 @@ def measure_group_consistency(df, group):
         df = df.groupby('year').sum().reset_index()
         base = 10
     else:
-        years = list(set(df['year']))
-        total_career_games_possible = sum([get_games_from_year(x) for x in years])
-        base = max(total_career_games_possible, 820)
-    results = {}
-    for stat in [*norm_factor]:
-        results['std_{stat}'.format(stat=stat)] = measure_vector_deviation(df[stat].values)
-        results['ent_raw_{stat}'.format(stat=stat)] = measure_vector_entropy(df[stat].values, base)
-        results['ent_norm_{stat}'.format(stat=stat)] =  results['ent_raw_{stat}'.format(stat=stat)]**norm_factor[stat]
-    results['entropy_score'] = np.nanmean([value for key, value in list(results.items()) if key.startswith('ent_norm_')])**2
-    results['deviation_score'] = np.nanmean([value for key, value in list(results.items()) if key.startswith('std_')])
-    results['consistency_score'] = np.nanmean([results['entropy_score'], results['deviation_score']])
-    score = pd.Series(results)
+        years = np.fromiter(set(df['year']), dtype=int)
+        base = max(int(_GAMES_BY_YEAR[years].sum()), 820)
+    vals = df[[*_NORM_COLS]].to_numpy(dtype=np.float64)
+    std_scores, ent_raw = score_columns(vals, base)
+    ent_norm = ent_raw**_NORM_EXP
+    entropy_score = np.nanmean(ent_norm)**2
+    deviation_score = np.nanmean(std_scores)
+    consistency_score = np.nanmean([entropy_score, deviation_score])
+    score = pd.Series([*np.column_stack([std_scores, ent_raw, ent_norm]).ravel(),
+                       entropy_score, deviation_score, consistency_score], index=_SCORE_INDEX)
     return score
 
 
+def measure_all_group_consistency(df, by, group):
+    """
+    Returns overall consistency scores for every group in one pass, matching
+    measure_group_consistency applied to each group
+    :param df: (df)
+    :param by: (list of str)
+    :param group: (str)
+    :return scores: (df)
+    """
+    stats_list = [*_NORM_COLS]
+    if group == 'sum_season':
+        df = df.groupby([*by, 'year'])[stats_list].sum().reset_index()
+    vals = df[stats_list].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xlogx = np.where(vals > 0, vals*np.log(vals), np.where(np.isnan(vals), np.nan, 0))
+    xlogx_list = ['xlogx_{stat}'.format(stat=stat) for stat in stats_list]
+    work = df[by].reset_index(drop=True)
+    work[stats_list] = vals
+    work[xlogx_list] = xlogx
+    work['games'] = _GAMES_BY_YEAR[df['year'].to_numpy()]
+    grouped = work.groupby(by)
+    sizes = grouped.size()
+    if group == 'player_season':
+        base = grouped['games'].first()
+    elif group == 'sum_season':
+        base = 10
+    else:
+        seasons = df[[*by, 'year']].drop_duplicates()
+        seasons['games'] = _GAMES_BY_YEAR[seasons['year'].to_numpy()]
+        base = seasons.groupby(by)['games'].sum().clip(lower=820)
+    adj_base = np.maximum(base, sizes).to_numpy(dtype=np.float64)
+    sums = grouped[stats_list].sum().to_numpy()
+    xlogx_sums = grouped[xlogx_list].sum().to_numpy()
+    stds = grouped[stats_list].std(ddof=0).to_numpy()
+    maxes = grouped[stats_list].max().to_numpy()
+    # Entropy of x/S expands to log(S) - sum(x*log(x))/S; clamp the roundoff below zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ent_raw = np.maximum(np.log(sums) - xlogx_sums/sums, 0)/np.log(adj_base)[:, None]
+        ent_raw[sums == 0] = np.nan
+        std_scores = 1 - stds/(maxes/2)
+    ent_norm = ent_raw**_NORM_EXP
+    scores = pd.DataFrame(np.stack([std_scores, ent_raw, ent_norm], axis=2).reshape(len(sizes), -1),
+                          index=sizes.index, columns=_SCORE_INDEX[:-3])
+    scores['entropy_score'] = pd.DataFrame(ent_norm).mean(axis=1).to_numpy()**2
+    scores['deviation_score'] = pd.DataFrame(std_scores).mean(axis=1).to_numpy()
+    scores['consistency_score'] = scores[['entropy_score', 'deviation_score']].mean(axis=1)
+    return scores
+
+
+@njit(cache=True, error_model='numpy')
+def score_columns(vals, base):
+    """
+    Returns the deviation score and raw entropy of each column in a single pass
+    :param vals: (2d array)
+    :param base: (int)
+    :return std_scores, ent_raw: (arrays)
+    """
+    n_rows, n_cols = vals.shape
+    log_base = np.log(max(base, n_rows))
+    std_scores = np.empty(n_cols)
+    ent_raw = np.empty(n_cols)
+    for c in range(n_cols):
+        total = 0.0
+        total_sq = 0.0
+        the_max = -np.inf
+        xlogx = 0.0
+        n = 0
+        for i in range(n_rows):
+            v = vals[i, c]
+            if np.isnan(v):
+                continue
+            total += v
+            total_sq += v*v
+            if v > the_max:
+                the_max = v
+            if v > 0:
+                xlogx += v*np.log(v)
+            n += 1
+        if n == 0:
+            std_scores[c] = np.nan
+            ent_raw[c] = np.nan
+            continue
+        mean = total/n
+        std = np.sqrt(max(total_sq/n - mean*mean, 0.0))
+        std_scores[c] = 1 - std/(the_max/2)
+        # Clamp the roundoff below zero left by log(S) - sum(x*log(x))/S
+        ent_raw[c] = max(np.log(total) - xlogx/total, 0.0)/log_base if total > 0 else np.nan
+    return std_scores, ent_raw
+
+
+@lru_cache(maxsize=None)
 def get_games_from_year(year):
     """
     Returns the mininum number of team games/season for each year.
     :param year: (int)
     :return games: (int)
     """
-    if year == 2021:
-        games = 72
-    elif year == 2020:
-        games = 70
-    elif year == 2012:
-        games = 66
-    elif year == 1999:
-        games = 50
-    elif year > 1967:
-        games = 82
-    elif year == 1967:
-        games = 81
-    elif year >= 1962:
-        games = 80
-    elif year == 1961:
-        games = 79
-    elif year == 1960:
-        games = 75
-    elif year >= 1954:
-        games = 72
-    elif year == 1953:
-        games = 69
-    elif year >= 1951:
-        games = 66
-    elif year == 1950:
-        games = 62
-    elif year == 1949:
-        games = 60
-    elif year == 1948:
-        games = 48
-    else:
-        games = 61
-    return games
+    return int(_GAMES_BY_YEAR[year])
 
 
 def measure_vector_entropy(vec, base):
@@ -109,9 +168,17 @@ def measure_vector_uniqueness(vec):
     Returns percentage of values that are unique
     :param vec: (array)
     :return unique_score: (float)
+    Missing values are ignored; small non-negative integer stats are counted with bincount
     """
-    unique = len(set(vec))
-    unique_score = 1 - (unique - 1)/len(vec)
+    vec = np.asarray(vec, dtype=np.float64)
+    vec = vec[~np.isnan(vec)]
+    if vec.size == 0:
+        return np.nan
+    if vec.min() >= 0 and vec.max() <= 10*vec.size and np.all(vec == np.floor(vec)):
+        unique = np.count_nonzero(np.bincount(vec.astype(np.int64)))
+    else:
+        unique = np.unique(vec).size
+    unique_score = 1 - (unique - 1)/vec.size
     return unique_score
 
 
@@ -120,3 +187,18 @@ norm_factor = {
     'pts': 3.25,
     'ast': 2,
 }
+_NORM_COLS = tuple(norm_factor)
+_NORM_EXP = np.array([norm_factor[stat] for stat in _NORM_COLS])
+_SCORE_INDEX = ['{kind}_{stat}'.format(kind=kind, stat=stat)
+                for stat in _NORM_COLS for kind in ('std', 'ent_raw', 'ent_norm')] \
+    + ['entropy_score', 'deviation_score', 'consistency_score']
+
+
+# Minimum number of team games/season, indexed by year
+_GAMES_BY_YEAR = np.full(2100, 82, dtype=np.int16)
+_GAMES_BY_YEAR[:1948] = 61
+_GAMES_BY_YEAR[1951:1953] = 66
+_GAMES_BY_YEAR[1954:1960] = 72
+_GAMES_BY_YEAR[1962:1967] = 80
+_GAMES_BY_YEAR[[1948, 1949, 1950, 1953, 1960, 1961, 1967, 1999, 2012, 2020, 2021]] = \
+    [48, 60, 62, 69, 75, 79, 81, 50, 66, 70, 72]
@@ -2,166 +2,319 @@
 Module for scraping data from basketball-reference.com
 """
 
-import copy
+import aiohttp
+import asyncio
+import concurrent.futures
 import datetime as dt
+import gzip
+import hashlib
 import numpy as np
 import os
 import pandas as pd
 import pickle
 import re
-import requests as rq
 import string
-import time
-from multiprocessing import Pool as ThreadPool
 
-from bs4 import BeautifulSoup
+from asyncio_throttle import Throttler
+from selectolax.lexbor import LexborHTMLParser
 
 
 def get_all_player_records():
     """
     Scrapes a master dictionary of all player gamelogs from Basketball-Reference
     :return all_players: (dict)
+    Synchronous wrapper for scripts; from a notebook, await fetch_all_player_records instead
+    """
+    return run_sync(fetch_all_player_records())
+
+
+async def fetch_all_player_records():
+    """
+    Scrapes a master dictionary of all player gamelogs from Basketball-Reference
+    :return all_players: (dict)
+    Every query shares one pooled session
+    """
+    async with open_session() as session:
+        all_players = await fetch_player_index(session)
+        await fetch_all_player_gamelogs(session, all_players)
+    save_meta(all_players)
+    save_df(convert_dict_to_df(all_players))
+    return all_players
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code
+    :param coro: (coroutine)
+    :return result: (any)
+    asyncio.run refuses to start inside a running event loop (e.g. Jupyter), so in that
+    case the coroutine runs on its own loop in a worker thread
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def fetch_all_player_gamelogs(session, all_players):
+    """
+    Queries the gamelogs of every player, then retries failed years
+    :param session: (aiohttp.ClientSession)
+    :param all_players: (dict)
     """
-    all_players = get_player_index()
     for key, value in list(all_players.items()):
         # If we have an incomplete pickle, we don't need to query again.
-    	if not all_players[key].get('gamelog'):
+        if not all_players[key].get('gamelog'):
             print("Fetching {} at {}".format(value['player_name'], dt.datetime.now()))
             years_active = range(value['start_year'], value['end_year'] + 1)
-            all_players[key]['urls'] = {year: copy.copy(player_gamelog_master) \
-                                                  .format(letter=value['first_letter'],
-                                                          player=key,
-                                                          year=year) for year in years_active}
-            all_players[key]['gamelog'] = get_player_gamelogs(all_players[key]['urls'])
+            all_players[key]['urls'] = {year: _gamelog_url(value['first_letter'], key, year)
+                                        for year in years_active}
+            # The final season may still be in progress, so it is never cached
+            gamelogs = await asyncio.gather(*[fetch_year_gamelog(session, year, url,
+                                                                 cache=year < value['end_year'])
+                                              for year, url in all_players[key]['urls'].items()])
+            all_players[key]['gamelog'] = dict(gamelogs)
     save_to_pickle(all_players)
-    all_players = try_missing_records_again(all_players)
+    await try_missing_records_again(session, all_players)
     save_to_pickle(all_players)
-    return all_players
+
+
+def _gamelog_url(letter, player, year):
+    """
+    Returns the URL of a player's gamelog for one season
+    :param letter: (str)
+    :param player: (str)
+    :param year: (int)
+    :return url: (str)
+    """
+    return f'https://www.basketball-reference.com/players/{letter}/{player}/gamelog/{year}'
 
 
 def get_player_index():
     """
     Loads the index of all player gamelog URLs
     :return all_players: (dict)
+    Synchronous wrapper for scripts
+    """
+    return run_sync(_with_session(fetch_player_index))
+
+
+async def fetch_player_index(session):
+    """
+    Loads the index of all player gamelog URLs
+    :param session: (aiohttp.ClientSession)
+    :return all_players: (dict)
     """
     print("Fetching the player indices at {}".format(dt.datetime.now()))
     if raw_save_file in os.listdir():
         with open(raw_save_file, 'rb') as fpath:
             all_players = pickle.load(fpath)
         print("Loaded index from pickle")
+    elif meta_save_file in os.listdir():
+        with open(meta_save_file, 'rb') as fpath:
+            all_players = pickle.load(fpath)
+        print("Loaded index from metadata")
     else:
         all_players = {}
-        for letter in string.ascii_lowercase:
-            letter_players = get_player_page_indices(letter)
+        for letter_players in await asyncio.gather(*[fetch_player_page_indices(session, letter)
+                                                     for letter in string.ascii_lowercase]):
             all_players.update(letter_players)
-            time.sleep(1)
         with open(raw_save_file, 'wb') as fpath:
             pickle.dump(all_players, fpath)
         print("Found {} players".format(len(all_players)))
     return all_players
 
 
-def get_player_page_indices(letter):
+async def fetch_player_page_indices(session, letter):
+    """
+    Queries the player index on Basketball-Reference.com for a given letter of the alphabet
+    :param session: (aiohttp.ClientSession)
+    :param letter: (str)
+    :return players: (dict)
+    """
+    index_url = player_url_master.format(letter=letter)
+    text = await fetch(session, index_url, cache=False)
+    return get_player_page_indices(text)
+
+
+def get_player_page_indices(text):
     """
     Returns a dictionary that scrapes the player index on Basketball-Reference.com for 
     a given letter of the alphabet.
-    :param url: (str)
+    :param text: (str)
     :return players: (dict)
     The record is indexed to player name and records necessary info for getting game logs:
     1. Player homepage
     2. Player start year
     3. Player end year
     """
-    index_url = copy.deepcopy(player_url_master).format(letter=letter)
-    player_url = copy.deepcopy(player_page_master)
-    response = rq.get(index_url, timeout=5)
-    text_bs = BeautifulSoup(response.text, 'html.parser')
-    table = text_bs.find_all('tbody')
-    rows = table[0].find_all('tr')
+    tree = LexborHTMLParser(text)
+    table = tree.css('tbody')
+    rows = table[0].css('tr')
     players = {}
     for row in rows:
-        page = row.find_all('a')[0]['href']
-        ids = re.match(player_url, page) 
+        link = row.css_first('a')
+        cells = row.css('td')
+        ids = player_page_re.match(link.attributes['href'])
         player = ids[2]
         players[player] = {}
         players[player]['first_letter'] = ids[1]
-        players[player]['player_name'] = row.find_all('a')[0].get_text()
-        players[player]['start_year'] = int(row.find_all('td')[0].get_text())
-        players[player]['end_year'] = int(row.find_all('td')[1].get_text())
+        players[player]['player_name'] = link.text()
+        players[player]['start_year'] = int(cells[0].text())
+        players[player]['end_year'] = int(cells[1].text())
     return players
 
 
-def get_player_gamelogs(gamelog_urls):
-    """
-    Returns dict of {player: {year: {game: stats}}}
-    :param gamelog_urls: (doct)
-    :return gamelog_dict: (dict)
-    This function uses multiprocessing to accelerate the query process
-    """
-    gamelog_dict = {}
-    gamelog_tups = list(gamelog_urls.items())
-    pool = ThreadPool(6)
-    gamelogs = pool.map(get_year_gamelog, gamelog_tups)
-    pool.close()
-    pool.join()
-    for year, year_dict in gamelogs:
-        gamelog_dict[year] = year_dict
-    return gamelog_dict
-
-
-def get_year_gamelog(tup):
+async def fetch_year_gamelog(session, year, url, cache=True):
     """
     Year-level query syntax with simple error handling
+    :param session: (aiohttp.ClientSession)
+    :param year: (int)
     :param url: (str)
-    :return year_dict: (dict)
+    :param cache: (bool)
+    :return year, year_dict: (tuple)
     """
-    year = tup[0]
-    url = tup[1]
     try:
         year_dict = {}
-        response = rq.get(url, timeout=5)
-        text_bs = BeautifulSoup(response.text, 'html.parser')
-        table = text_bs.find_all('tbody')
+        text = await fetch(session, url, cache)
+        tree = LexborHTMLParser(text)
+        table = tree.css('tbody')
         if table:
-            rs_rows = table[0].find_all('tr')
+            rs_rows = table[0].css('tr[id^="pgl_basic"]')
             year_dict = extract_game_stats(rs_rows, year)
-        time.sleep(0.75)
+    except aiohttp.ClientResponseError as e:
+        # A missing page is an empty season; other statuses are kept for retry.
+        # Only the repr is stored, since the live exception can't be pickled.
+        if e.status != 404:
+            print(e)
+            year_dict = {'error': repr(e)}
     except Exception as e:
         print(e)
-        year_dict = {'error': e}
-        time.sleep(360)
+        year_dict = {'error': repr(e)}
     return year, year_dict
 
 
+async def fetch(session, url, cache=True):
+    """
+    Returns the text of a page, paced by the shared rate limiter
+    :param session: (aiohttp.ClientSession)
+    :param url: (str)
+    :param cache: (bool)
+    :return text: (str)
+    The on-disk cache only exists to make retries and reruns cheap. Entries never expire,
+    so pages that can still change (the player index, a season in progress) must be
+    fetched with cache=False.
+    Rate limits, server errors and dropped connections are retried with exponential backoff.
+    """
+    fpath = get_cache_path(url)
+    if cache and os.path.exists(fpath):
+        with open(fpath, 'rb') as cache_file:
+            cached = cache_file.read()
+        try:
+            return gzip.decompress(cached).decode()
+        except (EOFError, OSError, UnicodeDecodeError):
+            # A corrupt cache entry is treated as a miss and refetched
+            pass
+    for attempt in range(max_retries + 1):
+        try:
+            async with throttler:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    if response.status in retry_statuses and attempt < max_retries:
+                        delay = get_retry_delay(response.headers.get('Retry-After'), attempt)
+                    else:
+                        response.raise_for_status()
+                        text = await response.text()
+                        break
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                raise
+            delay = get_retry_delay(None, attempt)
+        await asyncio.sleep(delay)
+    if not cache:
+        return text
+    # Write to a temp file first, so an interrupted run never leaves a truncated entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(fpath, os.getpid())
+    with open(tmp_path, 'wb') as cache_file:
+        cache_file.write(gzip.compress(text.encode()))
+    os.replace(tmp_path, fpath)
+    return text
+
+
+def get_retry_delay(retry_after, attempt):
+    """
+    Returns the seconds to wait before retrying, honoring the server's Retry-After header
+    :param retry_after: (str or None)
+    :param attempt: (int)
+    :return delay: (float)
+    """
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return backoff_factor * 2**attempt
+
+
+def get_cache_path(url):
+    """
+    Returns the on-disk cache location of a page
+    :param url: (str)
+    :return fpath: (str)
+    """
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(cache_dir, '{}.html.gz'.format(url_hash))
+
+
+async def _with_session(query, *args):
+    """
+    Runs a query coroutine inside its own connection-pooled session
+    :param query: (coroutine function)
+    :return result: (any)
+    """
+    async with open_session() as session:
+        return await query(session, *args)
+
+
+def open_session():
+    """
+    Returns a session with a pooled keep-alive connector and the scraper's headers
+    :return session: (aiohttp.ClientSession)
+    Must be called from inside a running event loop
+    """
+    connector = aiohttp.TCPConnector(limit=20)
+    return aiohttp.ClientSession(connector=connector, headers=request_headers)
+
+
 def extract_game_stats(rows, year):
     """
     Extracts stats from player's season gamelog
-    :param rows: (list of bs4)
+    :param rows: (list of selectolax nodes), already filtered to game rows
     :param gamelog_dict: (dict)
     :param year: (int)
     :return year_dict: (dict)
     """
     year_dict = {}
     for row in rows:
-        if (row.get('id') or '').startswith('pgl_basic'):
-            date = row.select('td[data-stat="date_game"]')[0].get_text()
-            year_dict[date] = {}
-            stats = [x.get('data-stat') for x in row.find_all('td') if x.get('data-stat')]
-            for stat_name in stats:
-                stat = row.select('td[data-stat="{stat_name}"]'.format(stat_name=stat_name))
-                stat = np.nan if not stat[0].get_text() else stat[0].get_text()
-                if stat_name == 'mp':
-                    time_split = stat.split(':') if isinstance(stat, str) else None
-                    minutes, seconds = (np.nan, np.nan) if not time_split \
-                        else (float(time_split[0]), float(time_split[1]))
-                    stat = minutes + seconds/60
-                year_dict[date][stat_name] = stat
+        date = None
+        entry = {}
+        for cell in row.css('td'):
+            stat_name = cell.attributes.get('data-stat')
+            if not stat_name:
+                continue
+            stat = cell.text()
+            if stat_name == 'date_game':
+                date = stat
+            if not stat:
+                stat = np.nan
+            entry[stat_name] = stat
+        year_dict[date] = entry
     return year_dict
 
 
-def try_missing_records_again(all_players):
+async def try_missing_records_again(session, all_players):
     """
     Looks for years that failed to scrape, then loops retries until the data is successfully queried.
+    :param session: (aiohttp.ClientSession)
     :param all_players: (dict)
     :return all_players: (dict)
     We stop after 4 failures to avoid an endless loop
@@ -172,8 +325,9 @@ def try_missing_records_again(all_players):
             if all_players[key]['gamelog'][year].get('error'):
                 attempt = 1
                 while all_players[key]['gamelog'][year].get('error') and attempt < 5:
-                    tup = (year, all_players[key]['urls'][year])
-                    all_players[key]['gamelog'][year] = get_year_gamelog(tup)[1]
+                    url = all_players[key]['urls'][year]
+                    cache = year < all_players[key]['end_year']
+                    all_players[key]['gamelog'][year] = (await fetch_year_gamelog(session, year, url, cache))[1]
                     attempt += 1
     return all_players
 
@@ -187,31 +341,88 @@ def save_to_pickle(all_players):
         pickle.dump(all_players, fpath)
 
 
+def save_meta(all_players):
+    """
+    Pickles the player index and gamelog URLs without the gamelogs themselves
+    :param all_players: (dict)
+    """
+    meta = {key: {field: value for field, value in player.items() if field != 'gamelog'}
+            for key, player in all_players.items()}
+    with open(meta_save_file, 'wb') as fpath:
+        pickle.dump(meta, fpath)
+
+
+def save_df(player_df):
+    """
+    Writes the gamelog dataframe to parquet
+    :param player_df: (df)
+    """
+    player_df.to_parquet(parquet_save_file, compression='zstd')
+
+
+def load_player_df():
+    """
+    Loads the gamelog dataframe, falling back to converting the raw pickle
+    :return player_df: (df)
+    """
+    if parquet_save_file in os.listdir():
+        return pd.read_parquet(parquet_save_file)
+    with open(raw_save_file, 'rb') as fpath:
+        all_players = pickle.load(fpath)
+    player_df = convert_dict_to_df(all_players)
+    save_meta(all_players)
+    save_df(player_df)
+    return player_df
+
+
 def convert_dict_to_df(all_players):
     """
     Converts the nested dictionary of game logs into a dataframe
     :param all_players: (dict)
     :return player_df: (df)
     """
-    player_df = pd.DataFrame({(i, j, k): all_players[i]['gamelog'][j][k]
-                           for i in list(all_players.keys()) 
-                           for j in list(all_players[i]['gamelog'].keys())
-                           for k in list(all_players[i]['gamelog'][j].keys())
-              }).transpose()
-    player_df = player_df.reset_index().rename(columns={'level_0': 'player_key',
-                                                    'level_1': 'year',
-                                                    'level_2': 'game_date'})
-    for stat in stats_to_measure:
-        player_df[stat] = player_df[stat].apply(float)
-    player_df['name'] = player_df['player_key'].apply(lambda x: all_players[x]['player_name'])
+    player_df = pd.DataFrame.from_records(build_records(all_players.items()))
+    # Minutes are scraped as 'MM:SS'; older pickles already hold them as floats
+    minutes = player_df['mp'].astype(str).str.partition(':')
+    player_df['mp'] = pd.to_numeric(minutes[0], errors='coerce') \
+        + pd.to_numeric(minutes[2], errors='coerce').fillna(0)/60
+    player_df[stats_to_measure] = player_df[stats_to_measure].astype('float32')
+    player_df['year'] = player_df['year'].astype('int16')
     player_df = player_df.loc[player_df.year <= 2021, :]
     return player_df
 
 
+def build_records(items):
+    """
+    Flattens players into one record per game
+    :param items: (iterable of (player_key, player_data) tuples)
+    :return records: (list of dicts)
+    Seasons that still failed after retries are logged and skipped
+    """
+    records = []
+    for player_key, player_data in items:
+        name = player_data['player_name']
+        for year, games in player_data['gamelog'].items():
+            if 'error' in games:
+                print("Skipping {} {}: {}".format(player_key, year, games['error']))
+                continue
+            for game_date, stats in games.items():
+                records.append({'player_key': player_key, 'name': name, 'year': year,
+                                'game_date': game_date, **stats})
+    return records
+
+
 player_url_master = 'https://www.basketball-reference.com/players/{letter}/'
-player_page_master = '/players/([a-z])/([A-Za-z0-9]+).html'
-player_gamelog_master = 'https://www.basketball-reference.com/players/{letter}/{player}/gamelog/{year}'
+player_page_re = re.compile(r'/players/([a-z])/([A-Za-z0-9]+)\.html')
 raw_save_file = 'player_data.pickle'
+meta_save_file = 'meta.pickle'
+parquet_save_file = 'player_data.parquet'
+cache_dir = 'cache'
+request_headers = {'User-Agent': 'Mozilla/5.0 (compatible; nba-consistency-scraper)'}
+throttler = Throttler(rate_limit=20, period=60)
+retry_statuses = {429, 500, 502, 503, 504}
+max_retries = 5
+backoff_factor = 2
 stats_to_measure = ['gs', 'mp', 'fg', 'fga', 'fg_pct', 'fg3', 'fg3a',
        'fg3_pct', 'ft', 'fta', 'ft_pct', 'orb', 'drb', 'trb', 'ast', 'stl',
        'blk', 'tov', 'pf', 'pts', 'game_score', 'plus_minus']